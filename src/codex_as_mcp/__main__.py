@@ -4,6 +4,7 @@ This entrypoint launches the minimal server implementation in src/codex_as_mcp/s
 """
 
 import argparse
+import sys
 
 from . import server
 
@@ -17,21 +18,29 @@ def _parse_env_kv(pair: str) -> tuple[str, str]:
     return key, value
 
 
+_PARSER = argparse.ArgumentParser(prog="codex-as-mcp", add_help=True, allow_abbrev=False)
+_PARSER.add_argument(
+    "--env",
+    action="append",
+    default=[],
+    metavar="KEY=VALUE",
+    help=(
+        "Set env var(s) for spawned Codex CLI processes (repeatable). "
+        "Useful for provider credentials (the env var name must match your provider's "
+        "`env_key` in Codex config.toml)."
+    ),
+)
+
+
 def main(argv: list[str] | None = None) -> None:
-    parser = argparse.ArgumentParser(prog="codex-as-mcp", add_help=True)
-    parser.add_argument(
-        "--env",
-        action="append",
-        default=[],
-        metavar="KEY=VALUE",
-        help=(
-            "Set env var(s) for spawned Codex CLI processes (repeatable). "
-            "Useful for provider credentials (the env var name must match your provider's "
-            "`env_key` in Codex config.toml)."
-        ),
-    )
-
-    args, _unknown = parser.parse_known_args(argv)
+    args, unknown = _PARSER.parse_known_args(argv)
+    # Unknown args are ignored, so flag likely --env typos (stdout is the MCP transport)
+    for arg in unknown:
+        if arg.startswith("--e"):
+            print(
+                f"codex-as-mcp: ignoring unknown argument '{arg}' (did you mean --env?)",
+                file=sys.stderr,
+            )
 
     overrides: dict[str, str] = {}
     for pair in args.env:
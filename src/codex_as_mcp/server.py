@@ -15,11 +15,12 @@ Notes:
 """
 
 import asyncio
+import atexit
 import os
+import shlex
 import shutil
 import tempfile
-import time
-from pathlib import Path
+import uuid
 
 from mcp.server.fastmcp import FastMCP, Context
 
@@ -28,12 +29,39 @@ from mcp.server.fastmcp import FastMCP, Context
 # Chosen to be long to accommodate non-trivial editing tasks.
 DEFAULT_TIMEOUT_SECONDS: int = 8 * 60 * 60  # 8 hours
 
+# Seconds between progress heartbeats while an agent is running.
+HEARTBEAT_INTERVAL_SECONDS: float = 2.0
+
+# Grace period (seconds) for each step of stopping a timed-out or cancelled agent.
+_TERMINATE_GRACE_SECONDS: float = 5.0
+
+
+# Fixed argv pieces for `codex e`; only the cwd, output path and prompt vary per run.
+_CODEX_CMD_PREFIX: tuple[str, ...] = ("e", "--cd")
+_CODEX_CMD_FLAGS: tuple[str, ...] = (
+    "--skip-git-repo-check",
+    "--dangerously-bypass-approvals-and-sandbox",
+    "--output-last-message",
+)
+
+# Chunk size used when draining the agent's stdout/stderr pipes.
+_PIPE_READ_CHUNK: int = 64 * 1024
+
+# Upper bound on the default number of agents a parallel batch runs at once.
+_DEFAULT_MAX_PARALLEL_AGENTS: int = 8
+
+# Only the tail of stdout/stderr is kept, and included in error reports.
+_ERROR_OUTPUT_TAIL_BYTES: int = 32 * 1024
+
 
 mcp = FastMCP("codex-subagent")
 
 
 _DEFAULT_CHILD_ENV_OVERRIDES: dict[str, str] = {}
 
+# Server-lifetime directory holding each agent's --output-last-message file.
+_OUTPUT_DIR: str | None = None
+
 
 def set_default_child_env(overrides: dict[str, str]) -> None:
     """Set default env overrides for spawned Codex CLI processes.
@@ -45,30 +73,155 @@ def set_default_child_env(overrides: dict[str, str]) -> None:
     _DEFAULT_CHILD_ENV_OVERRIDES.update(overrides)
 
 
-def _build_child_env() -> dict[str, str]:
+def _build_child_env() -> dict[str, str] | None:
+    """Return the env for spawned agents, or ``None`` to inherit ``os.environ`` as-is.
+
+    A copy of the environment is only built when there are overrides to apply.
+    """
+    if not _DEFAULT_CHILD_ENV_OVERRIDES:
+        return None
     merged = dict(os.environ)
     merged.update(_DEFAULT_CHILD_ENV_OVERRIDES)
     return merged
 
 
+# Resolved `codex` paths keyed by the PATH value they were looked up with.
+_CODEX_EXEC_CACHE: dict[str, str] = {}
+
+
 def _resolve_codex_executable() -> str:
     """Resolve the `codex` executable path or raise a clear error.
 
+    Successful lookups are cached per PATH value, so repeated spawns skip the
+    PATH walk; a changed PATH triggers a fresh lookup.
+
     Returns:
         str: Absolute path to the `codex` executable.
 
     Raises:
         FileNotFoundError: If the executable cannot be found in PATH.
     """
+    path_env = os.environ.get("PATH", "")
+    codex = _CODEX_EXEC_CACHE.get(path_env)
+    if codex:
+        return codex
+
     codex = shutil.which("codex")
     if not codex:
         raise FileNotFoundError(
             "Codex CLI not found in PATH. Please install it (e.g. `npm i -g @openai/codex`) "
             "and ensure your shell PATH includes the npm global bin."
         )
+    _CODEX_EXEC_CACHE[path_env] = codex
     return codex
 
 
+async def _drain(stream: asyncio.StreamReader | None) -> tuple[bytes, bool]:
+    """Read ``stream`` to EOF in fixed-size chunks so the child never blocks on a full pipe.
+
+    Only the last ``_ERROR_OUTPUT_TAIL_BYTES`` are kept, so memory stays bounded no
+    matter how much the agent logs.
+
+    Returns:
+        The kept tail and whether earlier output was dropped.
+    """
+    if stream is None:
+        return b"", False
+    buf = bytearray()
+    truncated = False
+    while chunk := await stream.read(_PIPE_READ_CHUNK):
+        buf += chunk
+        # Trim in batches rather than on every chunk
+        if len(buf) > 2 * _ERROR_OUTPUT_TAIL_BYTES:
+            del buf[:-_ERROR_OUTPUT_TAIL_BYTES]
+            truncated = True
+    if len(buf) > _ERROR_OUTPUT_TAIL_BYTES:
+        del buf[:-_ERROR_OUTPUT_TAIL_BYTES]
+        truncated = True
+    return bytes(buf), truncated
+
+
+async def _heartbeat(ctx: Context) -> None:
+    """Report progress every ``HEARTBEAT_INTERVAL_SECONDS`` until cancelled."""
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL_SECONDS)
+        try:
+            await ctx.report_progress(1, None, "Codex agent running...")
+        except Exception:
+            pass
+
+
+async def _stop_agent(proc: asyncio.subprocess.Process, drain_task: asyncio.Future) -> None:
+    """Stop a timed-out or cancelled agent and its pipe drains within bounded time.
+
+    SIGTERM goes first so the npm `codex` wrapper can forward it to its native child,
+    escalating to SIGKILL after ``_TERMINATE_GRACE_SECONDS``. Every wait is bounded,
+    since a child the wrapper failed to stop keeps stdout/stderr open.
+    """
+    try:
+        proc.terminate()
+    except ProcessLookupError:
+        pass
+    try:
+        # Process.wait() also waits for the pipes to close, i.e. for the wrapper's child
+        await asyncio.wait_for(proc.wait(), timeout=_TERMINATE_GRACE_SECONDS)
+    except asyncio.TimeoutError:
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+        try:
+            await asyncio.wait_for(proc.wait(), timeout=_TERMINATE_GRACE_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+    try:
+        # wait_for cancels the drains if the pipes are still held open
+        await asyncio.wait_for(drain_task, timeout=_TERMINATE_GRACE_SECONDS)
+    except asyncio.TimeoutError:
+        pass
+
+
+def _decode_tail(tail: tuple[bytes, bool]) -> str:
+    """Decode a drained ``(data, truncated)`` tail for an error report."""
+    data, truncated = tail
+    text = data.decode(errors="replace")
+    return "..." + text if truncated else text
+
+
+def _new_output_path() -> str:
+    """Return a unique last-message path inside the shared output directory.
+
+    The directory is created on first use (and again if something removed it) and
+    deleted when the server exits, so individual runs only create and unlink a file.
+    """
+    global _OUTPUT_DIR
+    if _OUTPUT_DIR is None or not os.path.isdir(_OUTPUT_DIR):
+        first_use = _OUTPUT_DIR is None
+        _OUTPUT_DIR = tempfile.mkdtemp(prefix="codex_output_")
+        if first_use:
+            atexit.register(lambda: shutil.rmtree(_OUTPUT_DIR, ignore_errors=True))
+    return os.path.join(_OUTPUT_DIR, f"{uuid.uuid4().hex}.md")
+
+
+def _read_last_message(path: str) -> str:
+    """Return the agent's last message, or an empty string if Codex wrote none."""
+    try:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return ""
+
+
+def _validate_prompt(prompt: object) -> str | None:
+    """Return an error message if ``prompt`` is unusable, otherwise ``None``."""
+    # Basic validation to avoid confusing UI errors
+    if not isinstance(prompt, str):
+        return "Error: 'prompt' must be a string."
+    if not prompt.strip():
+        return "Error: 'prompt' is required and cannot be empty."
+    return None
+
+
 @mcp.tool()
 async def spawn_agent(ctx: Context, prompt: str) -> str:
     """Spawn a Codex agent to work inside the current working directory.
@@ -82,35 +235,39 @@ async def spawn_agent(ctx: Context, prompt: str) -> str:
     Returns:
         The agent's final response (clean output from Codex CLI).
     """
-    # Basic validation to avoid confusing UI errors
-    if not isinstance(prompt, str):
-        return "Error: 'prompt' must be a string."
-    if not prompt.strip():
-        return "Error: 'prompt' is required and cannot be empty."
+    error = _validate_prompt(prompt)
+    if error:
+        return error
 
     try:
         codex_exec = _resolve_codex_executable()
     except FileNotFoundError as e:
         return f"Error: {e}"
 
-    work_directory = os.getcwd()
+    return await _run_codex_agent(ctx, prompt, codex_exec, _build_child_env())
+
+
+async def _run_codex_agent(
+    ctx: Context, prompt: str, codex_exec: str, env: dict[str, str] | None
+) -> str:
+    """Run one Codex agent with an already validated prompt and resolved executable.
 
-    with tempfile.TemporaryDirectory(prefix="codex_output_") as temp_dir:
-        output_path = Path(temp_dir) / "last_message.md"
-        output_path.touch()
+    ``env`` is the child environment (``None`` inherits the server's); batch callers
+    build it once and share it.
+    """
+    work_directory = os.getcwd()
 
+    output_path = _new_output_path()
+    try:
         # Quote the prompt so Codex CLI receives it wrapped in "..."
         quoted_prompt = '"' + prompt.replace('"', '\\"') + '"'
 
         cmd = [
             codex_exec,
-            "e",
-            "--cd",
+            *_CODEX_CMD_PREFIX,
             work_directory,
-            "--skip-git-repo-check",
-            "--dangerously-bypass-approvals-and-sandbox",
-            "--output-last-message",
-            str(output_path),
+            *_CODEX_CMD_FLAGS,
+            output_path,
             quoted_prompt,
         ]
 
@@ -121,49 +278,49 @@ async def spawn_agent(ctx: Context, prompt: str) -> str:
             pass
 
         try:
+            # close_fds=False lets CPython launch via posix_spawn instead of fork+exec.
+            # Fds Python opens are non-inheritable (PEP 446); only fds the host passed
+            # in as inheritable reach the agent. Adding cwd, preexec_fn or
+            # start_new_session here silently falls back to fork+exec.
             proc = await asyncio.create_subprocess_exec(
                 *cmd,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE,
-                env=_build_child_env(),
+                env=env,
+                close_fds=False,
             )
         except Exception as e:
             return f"Error: Failed to launch Codex agent: {e}"
 
-        stdout_task = asyncio.create_task(proc.stdout.read()) if proc.stdout else None
-        stderr_task = asyncio.create_task(proc.stderr.read()) if proc.stderr else None
+        # Drain both pipes concurrently with the wait below
+        drain_task = asyncio.gather(_drain(proc.stdout), _drain(proc.stderr))
 
         # Send periodic heartbeats while process runs
-        last_ping = time.monotonic()
-        while True:
-            try:
-                returncode = await asyncio.wait_for(proc.wait(), timeout=2.0)
-                break
-            except asyncio.TimeoutError:
-                now = time.monotonic()
-                if now - last_ping >= 2.0:
-                    last_ping = now
-                    try:
-                        await ctx.report_progress(1, None, "Codex agent running...")
-                    except Exception:
-                        pass
-
-        stdout = ""
-        if stdout_task:
-            stdout_bytes = await stdout_task
-            stdout = stdout_bytes.decode(errors="replace")
-
-        stderr = ""
-        if stderr_task:
-            stderr_bytes = await stderr_task
-            stderr = stderr_bytes.decode(errors="replace")
-
-        output = output_path.read_text(encoding="utf-8").strip()
+        heartbeat_task = asyncio.create_task(_heartbeat(ctx))
+        try:
+            returncode = await asyncio.wait_for(proc.wait(), timeout=DEFAULT_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            await _stop_agent(proc, drain_task)
+            return f"Error: Codex agent timed out after {DEFAULT_TIMEOUT_SECONDS} seconds."
+        except asyncio.CancelledError:
+            # Don't leave the agent running when the tool call itself is cancelled
+            await _stop_agent(proc, drain_task)
+            raise
+        finally:
+            heartbeat_task.cancel()
+
+        stdout_tail, stderr_tail = await drain_task
+
+        # Read off the event loop so parallel agents keep heartbeating
+        output = await asyncio.to_thread(_read_last_message, output_path)
 
         if returncode != 0:
+            # Agent logs are only decoded when they are reported
+            stdout = _decode_tail(stdout_tail)
+            stderr = _decode_tail(stderr_tail)
             details = [
                 "Error: Codex agent exited with a non-zero status.",
-                f"Command: {' '.join(cmd)}",
+                f"Command: {shlex.join(cmd)}",
                 f"Exit Code: {returncode}",
             ]
             if stderr:
@@ -175,6 +332,11 @@ async def spawn_agent(ctx: Context, prompt: str) -> str:
             return "\n".join(details)
 
         return output
+    finally:
+        try:
+            os.unlink(output_path)
+        except FileNotFoundError:
+            pass
 
 
 @mcp.tool()
@@ -185,7 +347,9 @@ async def spawn_agents_parallel(
     """Spawn multiple Codex agents in parallel.
 
     Each spawned agent reuses the server's current working directory
-    (``os.getcwd()``).
+    (``os.getcwd()``). At most ``CODEX_AS_MCP_MAX_PARALLEL`` agents run at once
+    (default: twice the CPU count, up to 8), and specs with identical prompts
+    share a single run.
 
     Args:
         agents: List of agent specs, each with a 'prompt' entry.
@@ -203,6 +367,23 @@ async def spawn_agents_parallel(
     if not agents:
         return [{"index": "0", "error": "Error: 'agents' list cannot be empty."}]
 
+    # Resolve the executable and child env once for the whole batch instead of per agent.
+    # A missing CLI is still reported per agent so callers get one result per index.
+    codex_error: str | None = None
+    try:
+        codex_exec = _resolve_codex_executable()
+    except FileNotFoundError as e:
+        codex_exec = ""
+        codex_error = f"Error: {e}"
+    child_env = _build_child_env()
+
+    semaphore = asyncio.Semaphore(_max_parallel_agents())
+    runs: dict[str, asyncio.Task[str]] = {}
+
+    async def run_limited(prompt: str) -> str:
+        async with semaphore:
+            return await _run_codex_agent(ctx, prompt, codex_exec, child_env)
+
     async def run_one(index: int, spec: dict) -> dict:
         """Run a single agent and return result with index."""
         try:
@@ -226,7 +407,15 @@ async def spawn_agents_parallel(
                 pass
 
             # Run the agent
-            output = await spawn_agent(ctx, prompt)
+            error = _validate_prompt(prompt) or codex_error
+            if error:
+                output = error
+            else:
+                # Identical prompts within a batch share a single Codex run
+                run = runs.get(prompt)
+                if run is None:
+                    run = runs[prompt] = asyncio.create_task(run_limited(prompt))
+                output = await run
 
             # Check if output contains an error
             if output.startswith("Error:"):
@@ -252,8 +441,33 @@ async def spawn_agents_parallel(
     return final_results
 
 
+def _max_parallel_agents() -> int:
+    """Return how many agents a parallel batch may run at once.
+
+    Read from ``CODEX_AS_MCP_MAX_PARALLEL``; unset or invalid values fall back to
+    twice the machine's CPU count, capped at ``_DEFAULT_MAX_PARALLEL_AGENTS``.
+    """
+    try:
+        limit = int(os.environ.get("CODEX_AS_MCP_MAX_PARALLEL", ""))
+    except ValueError:
+        limit = 0
+    if limit > 0:
+        return limit
+    return min(_DEFAULT_MAX_PARALLEL_AGENTS, 2 * (os.cpu_count() or 2))
+
+
+def _prewarm() -> None:
+    """Populate lookup caches at startup so the first tool call is as fast as later ones."""
+    try:
+        _resolve_codex_executable()
+    except FileNotFoundError:
+        # Report the missing CLI from the tool call instead of refusing to start.
+        pass
+
+
 def main() -> None:
     """Entry point for the MCP server v2."""
+    _prewarm()
     mcp.run()
 
 